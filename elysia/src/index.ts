@@ -1,4 +1,4 @@
-import { Elysia, t } from "elysia";
+import { Elysia, ParseError, t } from "elysia";
 import { cors } from '@elysiajs/cors';
 import { Database } from "bun:sqlite";
 
@@ -38,6 +38,22 @@ db.run(`
 let currentRelayState = false;
 let lastRelayChange = new Date().toISOString();
 
+// Pending ESP32 long-poll requests, woken on relay state change
+const RELAY_LONGPOLL_TIMEOUT = 60 * 1000;
+const relayWaiters = new Set<() => void>();
+
+function waitForRelayChange(timeoutMs: number): Promise<void> {
+  return new Promise(resolve => {
+    const done = () => {
+      clearTimeout(timer);
+      relayWaiters.delete(done);
+      resolve();
+    };
+    const timer = setTimeout(done, timeoutMs);
+    relayWaiters.add(done);
+  });
+}
+
 // Auto watering settings
 let AUTO_WATERING_SETTINGS = {
   threshold: 40,      // Trigger when humidity < 40%
@@ -67,6 +83,70 @@ function getTodayToggleCount(): number {
   return result.count;
 }
 
+// Minimal MessagePack decoder for ESP32 uploads
+function decodeMsgpack(buf: Uint8Array): unknown {
+  const view = new DataView(buf.buffer, buf.byteOffset, buf.byteLength);
+  const decoder = new TextDecoder();
+  let pos = 0;
+
+  const str = (len: number) => {
+    if (pos + len > buf.length) throw new Error('Truncated MessagePack string');
+    const value = decoder.decode(buf.subarray(pos, pos + len));
+    pos += len;
+    return value;
+  };
+  const arr = (len: number) => {
+    const value: unknown[] = [];
+    for (let i = 0; i < len; i++) value.push(read());
+    return value;
+  };
+  const map = (len: number) => {
+    // No prototype, so a "__proto__" key is stored as plain data
+    const value: Record<string, unknown> = Object.create(null);
+    for (let i = 0; i < len; i++) {
+      const key = String(read());
+      value[key] = read();
+    }
+    return value;
+  };
+  const fixed = (size: number, value: number) => {
+    pos += size;
+    return value;
+  };
+
+  function read(): unknown {
+    if (pos >= buf.length) throw new Error('Truncated MessagePack payload');
+    const type = buf[pos++];
+    if (type < 0x80) return type;
+    if (type < 0x90) return map(type & 0x0f);
+    if (type < 0xa0) return arr(type & 0x0f);
+    if (type < 0xc0) return str(type & 0x1f);
+    if (type >= 0xe0) return type - 0x100;
+    switch (type) {
+      case 0xc0: return null;
+      case 0xc2: return false;
+      case 0xc3: return true;
+      case 0xca: return fixed(4, view.getFloat32(pos));
+      case 0xcb: return fixed(8, view.getFloat64(pos));
+      case 0xcc: return fixed(1, view.getUint8(pos));
+      case 0xcd: return fixed(2, view.getUint16(pos));
+      case 0xce: return fixed(4, view.getUint32(pos));
+      case 0xd0: return fixed(1, view.getInt8(pos));
+      case 0xd1: return fixed(2, view.getInt16(pos));
+      case 0xd2: return fixed(4, view.getInt32(pos));
+      case 0xd9: return str(fixed(1, view.getUint8(pos)));
+      case 0xda: return str(fixed(2, view.getUint16(pos)));
+      case 0xdc: return arr(fixed(2, view.getUint16(pos)));
+      case 0xde: return map(fixed(2, view.getUint16(pos)));
+      default: throw new Error(`Unsupported MessagePack type 0x${type.toString(16)}`);
+    }
+  }
+
+  const value = read();
+  if (pos !== buf.length) throw new Error('Trailing bytes after MessagePack payload');
+  return value;
+}
+
 // Helper function to insert sensor data
 function insertSensorData(humidity: number, relayState: boolean) {
   const stmt = db.prepare(`
@@ -79,6 +159,7 @@ function insertSensorData(humidity: number, relayState: boolean) {
     logSystemEvent(`Relay state changed to: ${relayState ? 'ON' : 'OFF'}`, 'relay');
     lastRelayChange = new Date().toISOString();
     currentRelayState = relayState;  // Only update when changed
+    for (const notify of [...relayWaiters]) notify();
   }
 }
 
@@ -156,21 +237,46 @@ app
 
   // Submit sensor data from ESP32
   .post("/sensor-data",
-    ({ body, request }) => {
+    ({ body, request, set }) => {
       const clientIP = request.headers.get('x-forwarded-for') ||
         request.headers.get('x-real-ip') ||
         'unknown';
 
-      logSystemEvent(`ESP32 data - Humidity: ${body.humidity}%, Relay: ${body.relay_state}`, 'sensor');
+      // ESP32 uploads batches of { t, h, r } samples; a bare humidity is a single fresh sample
+      const now = body.now ?? 0;
+      const samples: Array<{ t: number; h: number; r?: boolean }> = body.samples ??
+        (body.humidity !== undefined ? [{ t: now, h: body.humidity }] : []);
+      if (samples.length === 0) {
+        // Not a 200: the ESP32 clears its buffer on any 200 response
+        set.status = 400;
+        return { success: false, message: "No sensor data provided" };
+      }
+      const latest = samples[samples.length - 1].h;
 
-      // Insert sensor data but DON'T update currentRelayState from ESP32
+      logSystemEvent(`ESP32 data - ${samples.length} sample(s), Humidity: ${latest}%, Relay: ${body.relay_state}`, 'sensor');
+
+      // Insert sensor data but DON'T update currentRelayState from ESP32.
+      // Timestamps are backdated by each sample's age on the device clock.
       const stmt = db.prepare(`
-        INSERT INTO sensor_data (humidity, relay_state) VALUES (?, ?)
+        INSERT INTO sensor_data (humidity, relay_state, timestamp)
+        VALUES (?, ?, datetime('now', ?))
       `);
-      stmt.run(body.humidity, body.relay_state ? 1 : 0);
+      db.transaction(() => {
+        for (const sample of samples) {
+          const relayState = sample.r ?? body.relay_state;
+          stmt.run(sample.h, relayState ? 1 : 0, `-${Math.max(0, now - sample.t)} seconds`);
+        }
+      })();
+
+      if (body.acked_state !== undefined) {
+        logSystemEvent(`ESP32 relay now ${body.acked_state ? 'ON' : 'OFF'}`, 'relay');
+      }
 
       // Check for auto watering conditions
-      checkAutoWatering(body.humidity);
+      checkAutoWatering(latest);
+
+      // Header lets the ESP32 pick up the relay state without parsing the body
+      set.headers['x-relay-state'] = currentRelayState ? '1' : '0';
 
       return {
         success: true,
@@ -181,9 +287,28 @@ app
       };
     },
     {
+      // ESP32 uploads are MessagePack; JSON bodies fall through to the default parser
+      parse: async ({ request, contentType }) => {
+        if (contentType === 'application/msgpack') {
+          const payload = new Uint8Array(await request.arrayBuffer());
+          try {
+            return decodeMsgpack(payload);
+          } catch (err) {
+            // Malformed payload is a client error (400), not a server fault
+            throw new ParseError(err as Error);
+          }
+        }
+      },
       body: t.Object({
-        humidity: t.Number({ minimum: 0, maximum: 100 }),
-        relay_state: t.Boolean()
+        humidity: t.Optional(t.Number({ minimum: 0, maximum: 100 })),
+        relay_state: t.Boolean(),
+        acked_state: t.Optional(t.Boolean()),
+        now: t.Optional(t.Number()),
+        samples: t.Optional(t.Array(t.Object({
+          t: t.Number(),
+          h: t.Number({ minimum: 0, maximum: 100 }),
+          r: t.Optional(t.Boolean())  // relay state when the sample was taken
+        })))
       })
     }
   )
@@ -266,6 +391,28 @@ app
     };
   })
 
+  // Long-poll relay status for ESP32: held until the state differs from
+  // the one the device reports, or until the timeout elapses
+  .get("/relay/longpoll",
+    async ({ query, set }) => {
+      if ((query.state === 1) === currentRelayState) {
+        await waitForRelayChange(RELAY_LONGPOLL_TIMEOUT);
+      }
+
+      set.headers['x-relay-state'] = currentRelayState ? '1' : '0';
+
+      return {
+        relayState: currentRelayState,
+        lastUpdated: lastRelayChange
+      };
+    },
+    {
+      query: t.Object({
+        state: t.Optional(t.Number({ minimum: 0, maximum: 1 }))
+      })
+    }
+  )
+
   // Get historical sensor data
   .get("/history",
     ({ query }) => {
@@ -427,7 +574,8 @@ app
 // Start server
 app.listen({
   hostname: "0.0.0.0",
-  port: 3000
+  port: 3000,
+  idleTimeout: 75  // seconds; must outlast the relay long-poll
 });
 
 console.log(`🚀 Elysia is running at http://0.0.0.0:3000`);
@@ -1,63 +1,285 @@
+import errno
 import network
-import urequests as requests
-from machine import Pin, ADC, Timer
+import select
+import socket
+import struct
+from machine import Pin, ADC
 import time
+import uasyncio as asyncio
+from micropython import const
 
 # Config
 WIFI_SSID = "your wifi ssid"
 WIFI_PASSWORD = "your wifi password"
-SERVER_URL = "http://192.168.1.3:3000/sensor-data"
+SERVER_IP = "192.168.1.3"
+SERVER_PORT = const(3000)
+SAMPLE_PERIOD_MS = const(30000)
+BATCH_N = const(12)  # samples per upload (6 min at 30 s cadence)
+HTTP_TIMEOUT = const(10)  # seconds to wait for an upload response
+LONGPOLL_TIMEOUT = const(75)  # seconds; server holds the request for up to 60 s
+_DEBUG = const(0)  # per-cycle serial logging; 0 lets the compiler drop it
 
 # Hardware
+_WLAN = network.WLAN(network.STA_IF)
+_WLAN.active(True)
+_WLAN.config(reconnects=-1)  # driver rejoins on its own after a drop
 relay = Pin(4, Pin.OUT)
 sensor = ADC(Pin(34))
 sensor.atten(ADC.ATTN_11DB)
+DRY_VALUE = const(4095)  # raw ADC reading in dry soil
+WET_VALUE = const(1500)  # raw ADC reading in water
+
+# Moisture percent for each 16-count step of the 12-bit raw reading
+_LUT = bytearray(256)
+for _i in range(256):
+    _m = (DRY_VALUE - (_i << 4)) * 100 // (DRY_VALUE - WET_VALUE)
+    _LUT[_i] = 0 if _m < 0 else 100 if _m > 100 else _m
+del _i, _m
 
 relay_state = False
+_ack_pending = False  # relay change not yet echoed back to the server
+
+# Server address and prebuilt requests. Uploads are minutes apart, well past
+# the server's idle timeout, so each one uses a fresh connection
+_SERVER_ADDR = None
+_HOST = SERVER_IP.encode()
+_REQ_SENSOR = (b"POST /sensor-data HTTP/1.1\r\nHost: " + _HOST +
+               b"\r\nContent-Type: application/msgpack\r\nConnection: close\r\nContent-Length: ")
+_REQ_LONGPOLL = (b"GET /relay/longpoll?state=%d HTTP/1.1\r\nHost: " + _HOST +
+                 b"\r\nConnection: keep-alive\r\n\r\n")
+_REQ_LONGPOLL_OFF = _REQ_LONGPOLL % 0
+_REQ_LONGPOLL_ON = _REQ_LONGPOLL % 1
+_RX = bytearray(128)
+_RXMV = memoryview(_RX)
+
+# Ring buffer of pending samples, packed as <IB (timestamp, moisture);
+# moisture is at most 100, so bit 7 carries the relay state at sample time
+_CAP = const(48)
+_ENTRY = const(5)
+_BUF = bytearray(_CAP * _ENTRY)
+_head = 0
+_count = 0
+
+# Reusable upload payload, hand-encoded as MessagePack for the fixed schema
+_PAYLOAD = bytearray(64 + _CAP * 15)
 
 def connect_wifi():
-    wlan = network.WLAN(network.STA_IF)
-    wlan.active(True)
-    if not wlan.isconnected():
-        wlan.connect(WIFI_SSID, WIFI_PASSWORD)
-        while not wlan.isconnected():
+    if not _WLAN.isconnected():
+        _WLAN.connect(WIFI_SSID, WIFI_PASSWORD)
+        while not _WLAN.isconnected():
             time.sleep(0.5)
-    print('WiFi connected:', wlan.ifconfig()[0])
+    print('WiFi connected:', _WLAN.ifconfig()[0])
     return True
 
 def read_moisture():
-    raw = sensor.read()
-    moisture = 100 - int((raw - 1500) * 100 / (4095 - 1500))
-    moisture = max(0, min(100, moisture))
-    print('Moisture:', moisture, '%')
+    moisture = _LUT[sensor.read() >> 4]
+    if _DEBUG:
+        print('Moisture:', moisture, '%')
     return moisture
 
-def send_data():
+def resolve_server():
+    global _SERVER_ADDR
+    _SERVER_ADDR = socket.getaddrinfo(SERVER_IP, SERVER_PORT)[0][-1]
+    print('Server address:', _SERVER_ADDR)
+
+async def _connect():
+    # Non-blocking connect on the cached address, then hand the socket to
+    # uasyncio so reads and writes wait in the event loop's poller
+    s = socket.socket()
+    try:
+        # Flush small requests immediately and detect dead peers; not every
+        # port exposes these options
+        try:
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (AttributeError, OSError):
+            pass
+        try:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        except (AttributeError, OSError):
+            pass
+        s.setblocking(False)
+        try:
+            s.connect(_SERVER_ADDR)
+        except OSError as e:
+            if e.errno != errno.EINPROGRESS:
+                raise
+        poller = select.poll()
+        poller.register(s, select.POLLOUT)
+        while True:
+            ready = poller.poll(0)
+            if ready:
+                break
+            await asyncio.sleep_ms(20)
+        if ready[0][1] & (select.POLLERR | select.POLLHUP):
+            raise OSError(errno.ECONNREFUSED, "connect failed")
+    except BaseException:
+        # Includes cancellation by a caller's wait_for
+        s.close()
+        raise
+    return s, asyncio.StreamReader(s)
+
+def push_sample(ts, moisture, state):
+    global _head, _count
+    if _count == _CAP:
+        # Buffer full: drop the oldest sample
+        _head = (_head + 1) % _CAP
+        _count -= 1
+    struct.pack_into("<IB", _BUF, ((_head + _count) % _CAP) * _ENTRY,
+                     ts, moisture | 0x80 if state else moisture)
+    _count += 1
+
+async def _send_request(stream, request, body=None):
+    # Writes the request and returns the HTTP status from the response line
+    stream.write(request)
+    if body is not None:
+        stream.write(b"%d\r\n\r\n" % len(body))
+        stream.write(body)
+    await stream.drain()
+    line = await stream.readline()
+    if not line:
+        raise OSError(errno.ECONNRESET, "connection closed before status line")
+    if line[:5] != b"HTTP/":
+        raise ValueError("bad status line")
+    return int(line.split(None, 2)[1])
+
+async def _read_response(stream):
+    # Returns the server's X-Relay-State (or None) from the headers;
+    # the response body is drained into _RX and discarded
+    length = 0
+    state = None
+    while True:
+        line = await stream.readline()
+        if not line or line == b"\r\n":
+            break
+        if line[:15].lower() == b"content-length:":
+            length = int(line[15:])
+        elif line[:14].lower() == b"x-relay-state:":
+            state = line[14:].strip() == b"1"
+    while length > 0:
+        n = await stream.readinto(_RXMV[:min(length, len(_RX))])
+        if not n:
+            raise OSError("connection closed")
+        length -= n
+    return state
+
+async def _exchange(request, body):
+    s, stream = await _connect()
+    try:
+        status = await _send_request(stream, request, body)
+        return status, await _read_response(stream)
+    finally:
+        s.close()
+
+async def _post(request, body):
+    # Returns (status, relay) where relay is the server's X-Relay-State or None;
+    # connect, write and read are all bounded by HTTP_TIMEOUT
+    return await asyncio.wait_for(_exchange(request, body), HTTP_TIMEOUT)
+
+def _put(n, chunk):
+    end = n + len(chunk)
+    _PAYLOAD[n:end] = chunk
+    return end
+
+def _build_payload():
+    # MessagePack: {now, relay_state, [acked_state,] samples: [{t, h, r}, ...]}
+    _PAYLOAD[0] = 0x84 if _ack_pending else 0x83
+    n = _put(1, b"\xa3now\xce")
+    struct.pack_into(">I", _PAYLOAD, n, time.time())
+    n = _put(n + 4, b"\xabrelay_state\xc3" if relay_state else b"\xabrelay_state\xc2")
+    if _ack_pending:
+        n = _put(n, b"\xabacked_state\xc3" if relay_state else b"\xabacked_state\xc2")
+    n = _put(n, b"\xa7samples\xdc")
+    struct.pack_into(">H", _PAYLOAD, n, _count)
+    n += 2
+    for i in range(_count):
+        ts, h = struct.unpack_from("<IB", _BUF, ((_head + i) % _CAP) * _ENTRY)
+        struct.pack_into(">BBBBIBBBBBBB", _PAYLOAD, n,
+                         0x83, 0xa1, 0x74, 0xce, ts, 0xa1, 0x68, 0xcc, h & 0x7f,
+                         0xa1, 0x72, 0xc3 if h & 0x80 else 0xc2)  # {"t": u32, "h": u8, "r": bool}
+        n += 15
+    return n
+
+def update_relay_state(state):
+    global relay_state, _ack_pending
+    if state != relay_state:
+        relay_state = state
+        relay.value(1 if state else 0)
+        # Echoed to the server in the next upload instead of a separate POST
+        _ack_pending = True
+        print('Relay:', 'ON' if state else 'OFF')
+
+async def send_batch():
+    global _count, _ack_pending
     try:
-        moisture = read_moisture()
-        data = {"humidity": moisture, "relay_state": relay_state}
-        response = requests.post(SERVER_URL, json=data, timeout=10)
-        print('Send status:', response.status_code)
-        response.close()
+        sent = _count
+        acked = _ack_pending
+        sent_state = relay_state
+        body = memoryview(_PAYLOAD)[:_build_payload()]
+        status, server_relay = await _post(_REQ_SENSOR, body)
+        if status != 200:
+            print('Send status:', status)
+            return False
+        if _DEBUG:
+            print('Sent samples:', sent)
+        _count = 0
+        # The long-poll may have changed the relay while the upload was in
+        # flight; that newer state still needs its own ack
+        if acked and relay_state == sent_state:
+            _ack_pending = False
+        if server_relay is not None:
+            update_relay_state(server_relay)
         return True
     except Exception as e:
         print('Send error:', e)
         return False
 
+async def sensor_task():
+    push_sample(time.time(), read_moisture(), relay_state)
+    if _count >= BATCH_N:
+        await send_batch()
+
+async def _relay_longpoll():
+    # Server holds each request until the relay differs from our state
+    while True:
+        s = None
+        try:
+            s, stream = await asyncio.wait_for(_connect(), HTTP_TIMEOUT)
+            while True:
+                status = await asyncio.wait_for(
+                    _send_request(stream, _REQ_LONGPOLL_ON if relay_state else _REQ_LONGPOLL_OFF),
+                    LONGPOLL_TIMEOUT)
+                server_relay = await asyncio.wait_for(_read_response(stream), HTTP_TIMEOUT)
+                if status != 200:
+                    print('Longpoll status:', status)
+                    break
+                if server_relay is not None:
+                    update_relay_state(server_relay)
+        except Exception as e:
+            print('Longpoll error:', e)
+        if s is not None:
+            s.close()
+        await asyncio.sleep_ms(5000)
+
+async def _scheduler():
+    # Fixed deadlines so time spent sampling and uploading doesn't drift the period
+    deadline = time.ticks_ms()
+    while True:
+        deadline = time.ticks_add(deadline, SAMPLE_PERIOD_MS)
+        await asyncio.sleep_ms(max(0, time.ticks_diff(deadline, time.ticks_ms())))
+        await sensor_task()
+
+async def _main():
+    asyncio.create_task(_relay_longpoll())
+    await _scheduler()
+
 def main():
     connect_wifi()
-    
-    def reading_task(t):
-        send_data()
-    
-    timer = Timer(0)
-    timer.init(period=z30000, mode=Timer.PERIODIC, callback=reading_task)
+    resolve_server()
     
     try:
-        while True:
-            time.sleep(1)
-    except:
-        timer.deinit()
+        asyncio.run(_main())
+    finally:
         relay.value(0)
+        asyncio.new_event_loop()
 
-main()
\ No newline at end of file
+main()